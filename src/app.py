@@ -1,9 +1,12 @@
 import io
 import os
 import sys
+import threading
 import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 # Allow running with `streamlit run src/app.py` by ensuring `src` is on sys.path
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -14,11 +17,14 @@ if CURRENT_DIR not in sys.path:
 # If deploying to Streamlit Community Cloud, requirements.txt is sufficient and preferred.
 # This block allows installing missing packages at runtime when the env var
 # ALLOW_RUNTIME_INSTALL is set to 1/true. After installing, the app reruns once.
-try:
-    from utils.bootstrap import ensure_packages  # type: ignore
-except Exception:
-    # utils may not exist; skip runtime install support
-    ensure_packages = None  # type: ignore
+# The env var is checked here so reruns without it skip the bootstrap import entirely.
+ensure_packages = None
+if os.getenv("ALLOW_RUNTIME_INSTALL", "").lower() in {"1", "true", "yes"}:
+    try:
+        from utils.bootstrap import ensure_packages  # type: ignore
+    except Exception:
+        # utils may not exist; skip runtime install support
+        ensure_packages = None  # type: ignore
 
 installed_runtime = False
 if ensure_packages is not None:
@@ -36,9 +42,17 @@ if installed_runtime:
 
 import cv2
 import numpy as np
-from PIL import Image
 
-from face_extractor.detector import detect_faces, crop_regions
+from face_extractor.detector import create_detector, detect_faces, crop_regions
+
+# Lowest value offered by the confidence slider. The shared detector runs at this
+# threshold and stricter thresholds are applied by filtering its output.
+MIN_DETECTOR_CONFIDENCE = 0.1
+# Longest side of the detection overlay shown in the UI
+PREVIEW_MAX_SIDE = 1024
+# Quality 85 with optimized Huffman tables and progressive scans: much smaller
+# files than OpenCV's default (95, baseline) with no visible loss at portrait size.
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 1, cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
 
 
 @dataclass
@@ -47,17 +61,74 @@ class FaceResult:
     score: float
 
 
-def load_image_to_bgr(uploaded_file) -> np.ndarray:
-    data = uploaded_file.read()
-    pil_img = Image.open(io.BytesIO(data)).convert("RGB")
-    rgb = np.array(pil_img)
-    bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
-    return bgr
+@dataclass
+class ExtractOptions:
+    conf: float
+    model_selection: int
+    margin: int
+    mode: str
+    max_faces: int
+
+
+class LockedDetector:
+    """Serializes `process()` on a detector shared by all sessions.
+
+    Streamlit runs each session in its own thread, and MediaPipe's
+    `process()` is not thread-safe.
+    """
+
+    def __init__(self, detector):
+        self._detector = detector
+        self._lock = threading.Lock()
+
+    def process(self, image: np.ndarray):
+        with self._lock:
+            return self._detector.process(image)
+
+
+@st.cache_resource(show_spinner=False)
+def get_detector(model_selection: int = 0) -> Optional[LockedDetector]:
+    # One detector per model for all reruns and sessions; avoids reloading the graph.
+    detector = create_detector(min_confidence=MIN_DETECTOR_CONFIDENCE, model_selection=model_selection)
+    if detector is None:
+        return None
+    shared = LockedDetector(detector)
+    # Dummy inference so MediaPipe's lazy setup doesn't land on the first upload
+    shared.process(np.zeros((256, 256, 3), dtype=np.uint8))
+    return shared
+
+
+def load_image_to_bgr(data: bytes) -> Optional[np.ndarray]:
+    # Decodes straight to a 3-channel BGR array; returns None if undecodable
+    if not data:
+        # cv2.imdecode asserts on an empty buffer instead of returning None
+        return None
+    arr = np.frombuffer(data, dtype=np.uint8)
+    return cv2.imdecode(arr, cv2.IMREAD_COLOR)
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def detect_upload(
+    data: bytes, model_selection: int, _image_bgr: np.ndarray
+) -> List[Tuple[Tuple[int, int, int, int], float]]:
+    # Keyed on the upload bytes and model; the leading underscore keeps the decoded
+    # image out of the hash, and only the small detection list is cached. Detection
+    # runs at the lowest threshold and the confidence slider is applied by the
+    # caller, so no slider retriggers it.
+    return detect_faces(
+        _image_bgr, min_confidence=MIN_DETECTOR_CONFIDENCE, detector=get_detector(model_selection)
+    )
 
 
 def draw_bboxes(image: np.ndarray, boxes: List[Tuple[int, int, int, int]], main_index: int) -> np.ndarray:
-    vis = image.copy()
-    for i, (x1, y1, x2, y2) in enumerate(boxes):
+    # Draw on a downscaled preview; st.image shrinks large images for display anyway
+    scale = min(1.0, PREVIEW_MAX_SIDE / max(image.shape[:2]))
+    if scale < 1.0:
+        vis = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        vis = image.copy()
+    for i, box in enumerate(boxes):
+        x1, y1, x2, y2 = (int(v * scale) for v in box)
         color = (0, 255, 0) if i == main_index else (255, 200, 0)
         cv2.rectangle(vis, (x1, y1), (x2, y2), color, 2)
         label = "main" if i == main_index else "face"
@@ -65,70 +136,153 @@ def draw_bboxes(image: np.ndarray, boxes: List[Tuple[int, int, int, int]], main_
     return vis
 
 
+def encode_image(img: np.ndarray, ext: str = ".jpg") -> np.ndarray:
+    # Returns OpenCV's encoded buffer as a flat uint8 array (empty on failure)
+    params = JPEG_PARAMS if ext.lower() in {".jpg", ".jpeg"} else []
+    ok, buf = cv2.imencode(ext, img, params)
+    return buf.reshape(-1) if ok else np.empty(0, dtype=np.uint8)
+
+
 def to_download_bytes(img: np.ndarray, ext: str = ".jpg") -> bytes:
-    ok, buf = cv2.imencode(ext, img)
-    return buf.tobytes() if ok else b""
+    # download_button needs real bytes; the ZIP path writes the buffers directly
+    return encode_image(img, ext).tobytes()
 
 
-def main():
-    st.title("ID Portrait Extractor")
-    st.caption("No-training approach using MediaPipe face detection to crop portrait(s) from ID images.")
+def encode_crops(crops: List[np.ndarray]) -> Tuple[np.ndarray, ...]:
+    # cv2.imencode releases the GIL, so several crops encode in parallel
+    if len(crops) <= 1:
+        return tuple(encode_image(crop) for crop in crops)
+    with ThreadPoolExecutor(max_workers=min(len(crops), os.cpu_count() or 1)) as ex:
+        return tuple(ex.map(encode_image, crops))
 
-    with st.sidebar:
-        st.header("Options")
-        conf = st.slider("Min confidence", 0.1, 0.99, 0.6, 0.01)
-        margin = st.slider("Crop margin (%)", 0, 40, 10, 1)
-        mode = st.radio("Return", ["Largest only", "All faces"], index=0)
-        max_faces = st.number_input("Max faces (when 'All faces')", min_value=1, max_value=10, value=5, step=1)
-        st.markdown("---")
-        st.markdown("Tip: If background faces are detected, capture a tighter photo of the ID.")
 
-    uploaded = st.file_uploader("Upload an ID card image", type=["jpg", "jpeg", "png", "webp"])
-    if not uploaded:
-        st.stop()
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_zip(
+    data: bytes,
+    boxes: Tuple[Tuple[int, int, int, int], ...],
+    margin: int,
+    _crops: List[np.ndarray],
+    _main_bytes: bytes,
+) -> bytes:
+    # Keyed on the upload bytes, boxes and margin, which fully determine the crops,
+    # so reruns with unchanged crops skip both encoding and zipping. The
+    # underscored arguments are derived from the key and excluded from hashing.
+    encoded = (_main_bytes,) + encode_crops(_crops[1:])
+    zip_buffer = io.BytesIO()
+    # JPEG data is already compressed, so store it rather than deflating again
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zf:
+        for i, jpeg in enumerate(encoded):
+            # memoryview lets zipfile read OpenCV's buffer without a bytes copy
+            zf.writestr(f"portrait_{i}.jpg", memoryview(jpeg))
+    return zip_buffer.getvalue()
+
 
-    image_bgr = load_image_to_bgr(uploaded)
-    detections = detect_faces(image_bgr, min_confidence=conf)
+def render_upload(uploaded, opts: ExtractOptions, key: str, prefix: str = "") -> None:
+    """Run detection and cropping for one uploaded file and render its results."""
+    data = uploaded.getvalue()
+    image_bgr = load_image_to_bgr(data)
+    if image_bgr is None:
+        st.error("Could not read the uploaded image. Please upload a JPG, PNG or WebP file.")
+        return
+    detections = detect_upload(data, opts.model_selection, image_bgr)
+    detections = [d for d in detections if d[1] >= opts.conf]
 
     if len(detections) == 0:
         st.warning("No faces detected. Try lowering the confidence or using a clearer image.")
-        st.image(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB), caption="Input", use_container_width=True)
-        st.stop()
+        st.image(image_bgr, channels="BGR", caption="Input", use_container_width=True)
+        return
 
-    # Sort by area (descending) and keep up to max_faces
-    detections.sort(key=lambda d: (d[0][2] - d[0][0]) * (d[0][3] - d[0][1]), reverse=True)
-    if mode == "Largest only":
+    # Sort by area (descending) and keep up to max_faces; a single face needs no sort
+    if len(detections) > 1:
+        detections.sort(key=lambda d: (d[0][2] - d[0][0]) * (d[0][3] - d[0][1]), reverse=True)
+    if opts.mode == "Largest only":
         detections = detections[:1]
     else:
-        detections = detections[:max_faces]
+        detections = detections[:opts.max_faces]
 
     boxes = [d[0] for d in detections]
     main_idx = 0  # after sorting, first is largest
     vis = draw_bboxes(image_bgr, boxes, main_idx)
-    st.image(cv2.cvtColor(vis, cv2.COLOR_BGR2RGB), caption="Detections", use_container_width=True)
+    st.image(vis, channels="BGR", caption="Detections", use_container_width=True)
 
-    crops = crop_regions(image_bgr, boxes, margin_percent=margin)
+    crops = crop_regions(image_bgr, boxes, margin_percent=opts.margin)
     if len(crops) == 0:
         st.error("Failed to crop faces.")
-        st.stop()
+        return
 
-    st.subheader("Cropped Portraits")
+    st.markdown("**Cropped Portraits**")
     cols = st.columns(min(3, len(crops)))
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        for i, crop in enumerate(crops):
-            rgb = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
-            cols[i % len(cols)].image(rgb, caption=f"portrait_{i}")
-            # Add to ZIP
-            zf.writestr(f"portrait_{i}.jpg", to_download_bytes(crop))
+    for i, crop in enumerate(crops):
+        cols[i % len(cols)].image(crop, channels="BGR", caption=f"portrait_{i}")
 
     # Main portrait download
     main_bytes = to_download_bytes(crops[0])
-    st.download_button("Download main portrait", data=main_bytes, file_name="portrait_main.jpg", mime="image/jpeg")
+    st.download_button(
+        "Download main portrait",
+        data=main_bytes,
+        file_name=f"{prefix}portrait_main.jpg",
+        mime="image/jpeg",
+        key=f"main_{key}",
+    )
+
+    # ZIP download: the remaining crops are only encoded and zipped once requested.
+    # The main portrait's bytes are reused rather than encoded again.
+    if st.checkbox("Prepare ZIP of all portraits", value=False, key=f"zip_opt_{key}"):
+        st.download_button(
+            "Download all as ZIP",
+            data=build_zip(data, tuple(boxes), opts.margin, crops, main_bytes),
+            file_name=f"{prefix}portraits.zip",
+            mime="application/zip",
+            key=f"zip_{key}",
+        )
+
+
+def main():
+    st.title("ID Portrait Extractor")
+    st.caption("No-training approach using MediaPipe face detection to crop portrait(s) from ID images.")
+
+    with st.sidebar:
+        st.header("Options")
+        conf = st.slider("Min confidence", MIN_DETECTOR_CONFIDENCE, 0.99, 0.6, 0.01)
+        face_range = st.radio(
+            "Face distance",
+            ["Close-up (short-range model)", "Far (full-range model)"],
+            index=0,
+            help="The short-range model is faster and suits photos of ID cards.",
+        )
+        model_selection = 0 if face_range.startswith("Close-up") else 1
+        margin = st.slider("Crop margin (%)", 0, 40, 10, 1)
+        mode = st.radio("Return", ["Largest only", "All faces"], index=0)
+        max_faces = st.number_input("Max faces (when 'All faces')", min_value=1, max_value=10, value=5, step=1)
+        st.markdown("---")
+        st.markdown("Tip: If background faces are detected, capture a tighter photo of the ID.")
+
+    uploads = st.file_uploader(
+        "Upload ID card image(s)", type=["jpg", "jpeg", "png", "webp"], accept_multiple_files=True
+    )
+    # Warm the detector after the uploader is on screen, while the user picks a file
+    get_detector(model_selection)
+    if not uploads:
+        st.stop()
 
-    # ZIP download
-    zip_buffer.seek(0)
-    st.download_button("Download all as ZIP", data=zip_buffer, file_name="portraits.zip", mime="application/zip")
+    opts = ExtractOptions(
+        conf=conf, model_selection=model_selection, margin=margin, mode=mode, max_faces=int(max_faces)
+    )
+    # Images are processed one after another and all share the cached detector
+    stems = [os.path.splitext(uploaded.name)[0] for uploaded in uploads]
+    stem_counts = Counter(stems)
+    for idx, (uploaded, stem) in enumerate(zip(uploads, stems)):
+        st.subheader(uploaded.name)
+        # Prefix download names with the source file's stem so batch downloads
+        # don't collide; repeated stems (e.g. card.jpg and card.png, or the same
+        # name from different folders) also get the upload's position.
+        prefix = ""
+        if len(uploads) > 1:
+            prefix = f"{stem}_"
+            if stem_counts[stem] > 1:
+                prefix += f"{idx}_"
+        # file_id keeps widget state attached to this file when others are removed
+        render_upload(uploaded, opts, key=uploaded.file_id, prefix=prefix)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,3 @@
-from .detector import detect_faces, crop_regions
-
-__all__ = ["detect_faces", "crop_regions"]
+from .detector import create_detector, detect_faces, crop_regions
 
+__all__ = ["create_detector", "detect_faces", "crop_regions"]
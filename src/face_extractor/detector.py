@@ -1,78 +1,151 @@
+import threading
 from typing import List, Tuple
 
 import cv2
 import numpy as np
 
-# Try to import mediapipe; fall back to OpenCV Haar cascades if unavailable.
-try:
-    import mediapipe as mp  # type: ignore
-    _HAVE_MEDIAPIPE = True
-except Exception:
-    mp = None  # type: ignore
-    _HAVE_MEDIAPIPE = False
+# mediapipe is imported on first use (see `_get_mediapipe()`) so importing this
+# module stays cheap; OpenCV Haar cascades are the fallback if it is unavailable.
+_MEDIAPIPE = None
+_MEDIAPIPE_CHECKED = False
 
+# BlazeFace downscales its input to a small fixed-size tensor, so larger inputs
+# only add preprocessing cost. Images are downscaled to this long side first.
+MAX_INFERENCE_SIDE = 640
 
-def _clip_box(x1: int, y1: int, x2: int, y2: int, w: int, h: int) -> Tuple[int, int, int, int]:
-    x1 = max(0, min(x1, w - 1))
-    y1 = max(0, min(y1, h - 1))
-    x2 = max(0, min(x2, w - 1))
-    y2 = max(0, min(y2, h - 1))
-    if x2 <= x1:
-        x2 = min(w - 1, x1 + 1)
-    if y2 <= y1:
-        y2 = min(h - 1, y1 + 1)
-    return x1, y1, x2, y2
+# Haar cascade for the fallback path, loaded on first use (see `_get_haar()`).
+# It is shared across Streamlit session threads and detectMultiScale is not
+# thread-safe, so the lock guards both the lazy load and every detection.
+_HAAR_CASCADE = None
+_HAAR_LOCK = threading.Lock()
 
 
-def detect_faces(image_bgr: np.ndarray, min_confidence: float = 0.6) -> List[Tuple[Tuple[int, int, int, int], float]]:
+def _clip_boxes(boxes: np.ndarray, w: int, h: int) -> np.ndarray:
+    """Clip an (N, 4) int array of x1, y1, x2, y2 boxes to the image in place."""
+    np.clip(boxes[:, 0::2], 0, w - 1, out=boxes[:, 0::2])
+    np.clip(boxes[:, 1::2], 0, h - 1, out=boxes[:, 1::2])
+    # Keep boxes at least one pixel wide/tall where the image allows it
+    boxes[:, 2] = np.minimum(np.maximum(boxes[:, 2], boxes[:, 0] + 1), w - 1)
+    boxes[:, 3] = np.minimum(np.maximum(boxes[:, 3], boxes[:, 1] + 1), h - 1)
+    return boxes
+
+
+def _clipped_detections(raw_boxes, scores: List[float], w: int, h: int) -> List[Tuple[Tuple[int, int, int, int], float]]:
+    if len(scores) == 0:
+        return []
+    b = _clip_boxes(np.array(raw_boxes, dtype=np.int64).reshape(-1, 4), w, h)
+    return [(tuple(box), score) for box, score in zip(b.tolist(), scores)]
+
+
+def _get_haar():
+    global _HAAR_CASCADE
+    if _HAAR_CASCADE is None:
+        with _HAAR_LOCK:
+            if _HAAR_CASCADE is None:
+                cascade_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+                _HAAR_CASCADE = cv2.CascadeClassifier(cascade_path)
+    return _HAAR_CASCADE
+
+
+def _get_mediapipe():
+    global _MEDIAPIPE, _MEDIAPIPE_CHECKED
+    if not _MEDIAPIPE_CHECKED:
+        try:
+            import mediapipe as mp  # type: ignore
+            _MEDIAPIPE = mp
+        except Exception:
+            _MEDIAPIPE = None
+        _MEDIAPIPE_CHECKED = True
+    return _MEDIAPIPE
+
+
+def create_detector(min_confidence: float = 0.1, model_selection: int = 0):
+    """Create a reusable MediaPipe FaceDetection instance.
+
+    `model_selection` 0 is the short-range model (faces within ~2 m, faster and
+    suited to ID photos); 1 is the full-range model (up to ~5 m).
+
+    Returns None when MediaPipe is unavailable. The caller owns the instance
+    and should keep it alive across calls (e.g. via `st.cache_resource`).
+    """
+    mp = _get_mediapipe()
+    if mp is None:
+        return None
+    mp_fd = mp.solutions.face_detection
+    return mp_fd.FaceDetection(model_selection=model_selection, min_detection_confidence=min_confidence)
+
+
+def detect_faces(
+    image_bgr: np.ndarray, min_confidence: float = 0.6, detector=None, model_selection: int = 0
+) -> List[Tuple[Tuple[int, int, int, int], float]]:
     """Detect faces using MediaPipe if available; otherwise OpenCV Haar cascade.
 
+    `detector` is an optional instance from `create_detector()` (or a wrapper
+    exposing the same `process()` method). When given, it is reused instead of
+    building a new graph, and detections below `min_confidence` are filtered
+    here. Otherwise a temporary detector is built with `model_selection` (see
+    `create_detector()`).
+
     Returns a list of tuples: ((x1, y1, x2, y2), score)
     Coordinates are absolute pixels in the input image space.
     """
     h, w = image_bgr.shape[:2]
 
     # Preferred: MediaPipe
-    if _HAVE_MEDIAPIPE:
-        mp_fd = mp.solutions.face_detection
-        image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-        with mp_fd.FaceDetection(model_selection=1, min_detection_confidence=min_confidence) as fd:
-            results = fd.process(image_rgb)
-        detections: List[Tuple[Tuple[int, int, int, int], float]] = []
+    if _get_mediapipe() is not None:
+        small = image_bgr
+        scale = min(1.0, MAX_INFERENCE_SIDE / max(h, w))
+        if scale < 1.0:
+            small = cv2.resize(image_bgr, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # Channel-reversed view made contiguous: a plain copy, no per-pixel conversion
+        image_rgb = np.ascontiguousarray(small[..., ::-1])
+        if detector is not None:
+            results = detector.process(image_rgb)
+        else:
+            with create_detector(min_confidence, model_selection) as fd:
+                results = fd.process(image_rgb)
+        raw_boxes: List[Tuple[int, int, int, int]] = []
+        scores: List[float] = []
         if results.detections:
             for det in results.detections:
+                score = det.score[0] if det.score else 0.0
+                if score < min_confidence:
+                    continue
+                # Relative coordinates, so scale back with the original w/h
                 rel = det.location_data.relative_bounding_box
                 x1 = int(rel.xmin * w)
                 y1 = int(rel.ymin * h)
                 x2 = int((rel.xmin + rel.width) * w)
                 y2 = int((rel.ymin + rel.height) * h)
-                x1, y1, x2, y2 = _clip_box(x1, y1, x2, y2, w, h)
-                score = det.score[0] if det.score else 0.0
-                detections.append(((x1, y1, x2, y2), float(score)))
-        return detections
+                raw_boxes.append((x1, y1, x2, y2))
+                scores.append(float(score))
+        return _clipped_detections(raw_boxes, scores, w, h)
 
     # Fallback: Haar cascade (no confidence scores)
     gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
-    cascade_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-    face_cascade = cv2.CascadeClassifier(cascade_path)
-    rects = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(60, 60))
-    dets: List[Tuple[Tuple[int, int, int, int], float]] = []
-    for (x, y, bw, bh) in rects:
-        x1, y1, x2, y2 = _clip_box(int(x), int(y), int(x + bw), int(y + bh), w, h)
-        dets.append(((x1, y1, x2, y2), 1.0))
-    return dets
+    face_cascade = _get_haar()
+    with _HAAR_LOCK:
+        rects = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(60, 60))
+    if len(rects) == 0:
+        return []
+    raw_boxes = np.asarray(rects, dtype=np.int64)
+    raw_boxes[:, 2:] += raw_boxes[:, :2]  # (x, y, w, h) -> (x1, y1, x2, y2)
+    return _clipped_detections(raw_boxes, [1.0] * len(raw_boxes), w, h)
 
 
 def crop_regions(image_bgr: np.ndarray, boxes: List[Tuple[int, int, int, int]], margin_percent: int = 10) -> List[np.ndarray]:
+    if len(boxes) == 0:
+        return []
     h, w = image_bgr.shape[:2]
     margin_percent = max(0, margin_percent)
+    b = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+    m = (b[:, 2:] - b[:, :2]) * margin_percent // 100
+    b[:, :2] -= m
+    b[:, 2:] += m
+    _clip_boxes(b, w, h)
     crops: List[np.ndarray] = []
-    for (x1, y1, x2, y2) in boxes:
-        bw, bh = x2 - x1, y2 - y1
-        mx = int(bw * margin_percent / 100)
-        my = int(bh * margin_percent / 100)
-        cx1, cy1, cx2, cy2 = _clip_box(x1 - mx, y1 - my, x2 + mx, y2 + my, w, h)
-        crop = image_bgr[cy1:cy2, cx1:cx2]
+    for x1, y1, x2, y2 in b.tolist():
+        crop = image_bgr[y1:y2, x1:x2]
         if crop.size > 0:
             crops.append(crop)
     return crops
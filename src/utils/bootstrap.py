@@ -19,18 +19,19 @@ DEFAULT_PACKAGES: Dict[str, Optional[str]] = {
     # Use headless OpenCV by default for cloud environments
     "opencv-python-headless": None,
     "numpy": None,
-    "Pillow": None,
 }
 
 
 def _module_name(pip_name: str) -> str:
     # Map pip package names to importable module names
-    if pip_name == "Pillow":
-        return "PIL"
+    if pip_name.startswith("opencv-"):
+        return "cv2"
     return pip_name.replace("-", "_")
 
 
 def _is_installed(module_name: str) -> bool:
+    if module_name in sys.modules:
+        return True
     try:
         importlib.import_module(module_name)
         return True